@@ -0,0 +1,142 @@
+"""Benchmark for the student services script that runs synthetic students through the same assignment and comparison code, without needing PowerSchool or the SFTP server.
+
+https://github.com/Philip-Greyson/D118-PS-Counselor-Population
+
+Generates fake rows in the same 15 column shape as the student query, with roughly the mix of inactive, elementary, middle school, high school, academy and ILS students we see in our district.
+Most students already have the staff they should, with a small percentage needing changes, the same as a normal night. Use --change-rate 1 to simulate the start of year mass reassignment.
+The rows for each size are generated before anything is timed, so generating them (which uses the script's own assignment code for the stored staff) is not counted in any phase.
+For each size it reports the time taken to generate the rows, the throughput, the peak memory used (through tracemalloc, which is measured in a separate pass since it slows everything down, and does not count the generated rows),
+the student counts, and the time spent in each phase using the same RunMetrics the script exports: fetch (handing over the already generated batches, standing in for the Oracle fetch), assign, diff, file_write (to a temporary output file on the background writer thread) and upload (hashing that file and copying it to a temporary directory, standing in for SFTP).
+
+Run with: python benchmark.py --rows 10000 100000 1000000, and add --columnar to compare the columnar batch mode.
+"""
+
+# importing module
+import argparse  # needed to parse the command line options
+import json  # needed to read the high school caseload file for the staff names
+import os  # needed to set up fake staff environment variables
+import random  # used to generate the synthetic students
+import shutil  # used to copy the output file as a stand-in for the upload
+import string
+import tempfile  # used for the output file and fake upload directory
+import tracemalloc  # used to measure peak memory
+from time import perf_counter  # used to time generating the rows
+
+# the staff names are read from environment variables when counselors is imported, so fill in placeholders for any that are not set before importing it
+CASELOAD_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hs_caseloads.json')
+with open(CASELOAD_FILE) as caseloadFile:
+    STAFF_VARIABLES = {caseload[role] for caseload in json.load(caseloadFile)['ranges'] for role in ['counselor', 'dean', 'social', 'psych']}
+STAFF_VARIABLES.update(['WHS_GUIDANCE_ACADEMY', 'WHS_SOCIAL_ACADEMY', 'WHS_SOCIAL_ILS', 'WMS_GUIDANCE', 'WMS_SOCIAL', 'WMS_PSYCH', 'MMS_GUIDANCE', 'MMS_SOCIAL', 'MMS_PSYCH'])
+for variable in STAFF_VARIABLES:
+    os.environ.setdefault(variable, variable.replace('_', ' ').title())
+    os.environ.setdefault(variable + '_EMAIL', variable.lower() + '@example.org')
+
+import counselors  # noqa: E402 the environment variables above need to be set first
+
+INACTIVE_RATE = 0.55  # historical students (graduated, transferred out, etc) make up most of the students table
+HIGH_SCHOOL_RATE = 0.35  # share of active students that are in the high school, the rest are split between the middle schools and elementary buildings
+MIDDLE_SCHOOL_RATE = 0.25
+ACADEMY_RATE = 0.06  # share of high schoolers in the academy
+ILS_RATE = 0.04  # share of high schoolers in ILS
+IGNORED_SCHOOL_RATE = 0.01  # share of students in one of the ignored schools
+DEFAULT_CHANGE_RATE = 0.02  # share of students whose stored staff does not match what they should have
+ELEMENTARY_SCHOOLS = [1001, 1002, 1005, 1006, 1007]
+MIDDLE_SCHOOLS = list(counselors.MIDDLE_SCHOOL_ASSIGNMENTS)
+
+
+def stored_fields(assignment):
+    """Put the values of an Assignment into the positions of the stored staff fields in the student query, with blanks as None like the database returns them."""
+    counselor, counselorEmail, dean, deanEmail, social, socialEmail, psych, psychEmail = [value or None for value in assignment]
+    return counselor, dean, social, psych, counselorEmail, deanEmail, socialEmail, psychEmail
+
+
+def synthetic_batches(rowCount, changeRate, seed):
+    """Generator that yields batches of FETCH_ARRAYSIZE synthetic student rows in the same shape and student number order as the student query, the same way fetch_student_batches() does for the database."""
+    rng = random.Random(seed)
+    staffValues = list({value for variants in counselors.HS_RANGE_ASSIGNMENTS for assignment in variants for value in assignment if value})  # used for students whose stored staff is wrong
+    batch = []
+    for stuID in range(rowCount, 0, -1):
+        last = rng.choice(string.ascii_uppercase) + ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(1, 10)))
+        isAcademy = isILS = 0
+        if rng.random() < INACTIVE_RATE:
+            enroll = rng.choice([2, 3, -1])
+            grade = rng.randint(0, 12)
+            school = rng.choice(ELEMENTARY_SCHOOLS + MIDDLE_SCHOOLS + [1000])
+        else:
+            enroll = 0
+            kind = rng.random()
+            if kind < HIGH_SCHOOL_RATE:
+                grade = rng.randint(9, 12)
+                school = 1000
+                isAcademy = 1 if rng.random() < ACADEMY_RATE else 0
+                isILS = 1 if rng.random() < ILS_RATE else 0
+            elif kind < HIGH_SCHOOL_RATE + MIDDLE_SCHOOL_RATE:
+                grade = rng.randint(6, 8)
+                school = rng.choice(MIDDLE_SCHOOLS)
+            else:
+                grade = rng.randint(0, 5)
+                school = rng.choice(ELEMENTARY_SCHOOLS)
+        if rng.random() < IGNORED_SCHOOL_RATE:
+            school = counselors.IGNORED_SCHOOLS[0]
+        if rng.random() < changeRate:  # give them some other staff, or nothing, so they show up as a change
+            stored = tuple(rng.choice(staffValues + [None]) for _ in range(8))
+        else:
+            stored = stored_fields(counselors.find_assignment(stuID, last.lower(), grade, enroll, school, bool(isAcademy), bool(isILS))[1])
+        counselor, dean, social, psych, counselorEmail, deanEmail, socialEmail, psychEmail = stored
+        batch.append((stuID, last, grade, enroll, school, counselor, dean, social, psych, counselorEmail, isAcademy, isILS, deanEmail, socialEmail, psychEmail))
+        if len(batch) == counselors.FETCH_ARRAYSIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_benchmark(batches, workDirectory, columnar=False):
+    """Run already generated batches of synthetic students through the script's phases, and return the RunMetrics with the time spent in each phase and the student counts."""
+    metrics = counselors.RunMetrics()
+    outputPath = os.path.join(workDirectory, counselors.OUTPUT_FILE_NAME)
+    uploadDirectory = os.path.join(workDirectory, 'upload')
+    os.makedirs(uploadDirectory, exist_ok=True)
+    with open(outputPath, 'w') as output, counselors.output_writer(output, metrics) as write:
+        for batchSize, lines in counselors.process_batches(batches, metrics=metrics, columnar=columnar):
+            if lines:
+                write(lines)
+    with metrics.phase('upload'):
+        counselors.file_sha256(outputPath)  # the real upload hashes the file to decide if it needs to be sent
+        shutil.copyfile(outputPath, os.path.join(uploadDirectory, counselors.OUTPUT_FILE_NAME))
+    return metrics
+
+
+def peak_memory(batches, workDirectory, columnar=False):
+    """Run the benchmark again under tracemalloc and return the peak memory it used in MB. The batches were allocated before tracing starts so they are not counted."""
+    tracemalloc.start()
+    try:
+        run_benchmark(batches, workDirectory, columnar)
+        return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    finally:
+        tracemalloc.stop()
+
+
+if __name__ == '__main__':  # main file execution
+    parser = argparse.ArgumentParser(description='Benchmark the student services script against synthetic students')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000], help='number of synthetic students to run, more than one size can be given (default: 10000 100000)')
+    parser.add_argument('--change-rate', type=float, default=DEFAULT_CHANGE_RATE, help=f'share of students whose stored staff needs to change (default: {DEFAULT_CHANGE_RATE})')
+    parser.add_argument('--seed', type=int, default=118, help='random seed so runs are repeatable (default: 118)')
+    parser.add_argument('--columnar', action='store_true', help='use the columnar batch mode of the script instead of processing each row on its own')
+    parser.add_argument('--skip-memory', action='store_true', help='skip the separate tracemalloc pass used to measure peak memory')
+    args = parser.parse_args()
+
+    counselors.logger.setLevel('ERROR')  # the warnings for every changed student would swamp the report
+    with tempfile.TemporaryDirectory() as workDirectory:
+        for rowCount in args.rows:
+            generateStart = perf_counter()
+            batches = list(synthetic_batches(rowCount, args.change_rate, args.seed))
+            generateElapsed = perf_counter() - generateStart
+            metrics = run_benchmark(batches, workDirectory, args.columnar)
+            processing = metrics.phases['assign'] + metrics.phases['diff']
+            total = sum(metrics.phases.values())
+            print(f'{rowCount} students generated in {generateElapsed:.3f}s, {metrics.counts["changed"]} changed: {total:.3f}s total, {rowCount / processing if processing else 0:.0f} students/sec through assign + diff')
+            print('    ' + ' | '.join(f'{phase} {elapsed:.3f}s' for phase, elapsed in metrics.phases.items()))
+            print('    ' + ' | '.join(f'{category} {count}' for category, count in sorted(metrics.counts.items())))
+            if not args.skip_memory:
+                print(f'    peak memory {peak_memory(batches, workDirectory, args.columnar):.1f} MB')
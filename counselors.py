@@ -11,9 +11,26 @@ needs pysftp: pip install pysftp --upgrade
 """
 
 # importing module
+import argparse  # needed to parse the command line options for the optional run modes
+import csv  # used to write the dry run change report
 import datetime  # used to get current date for course info
+import hashlib  # used to fingerprint the student fields that decide their staff
+import heapq  # used to merge the per school results back into one ordered file
+import json  # needed to read the high school caseload config file
+import logging  # used for the console and log file output
 import os  # needed to get environement variables
+import queue  # used to hand log messages off to the background log writer
+import sqlite3  # needed for the local snapshot of last run's assignments
+import sys
+import threading  # needed to share the snapshot between the worker threads
+from array import array  # typed columns for the columnar batch mode
+from bisect import bisect_right  # used to find which caseload range a last name falls in
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor  # used to process each school in parallel
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
 from datetime import *
+from time import perf_counter, sleep  # high resolution timer used to measure query throughput, and sleep to wait between upload retries
 
 import oracledb  # needed for connection to PowerSchool (oracle database)
 import pysftp  # needed for sftp file upload
@@ -29,20 +46,30 @@ SFTP_HOST = os.environ.get('D118_SFTP_ADDRESS')  # ip address/URL for the d118 s
 CNOPTS = pysftp.CnOpts(knownhosts='known_hosts')  # connection options to use the known_hosts file for key validation
 
 OUTPUT_FILE_NAME = 'studentServices.txt'
+LOG_FILE_NAME = 'counselor_log.txt'
+LOG_BUFFER_SIZE = 1024 * 1024  # bytes of log output buffered in memory before it is written to the log file
 OUTPUT_FILE_DIRECTORY = '/sftp/studentServices/'
+UPLOAD_MANIFEST_SUFFIX = '.sha256'  # sidecar file next to the output on the sftp server that holds the hash and size of the last upload
+UPLOAD_RETRIES = 3  # number of times to try the upload before giving up
+UPLOAD_RETRY_DELAY = 10  # seconds to wait between upload attempts
+UPLOAD_CHUNK_SIZE = 32768  # bytes sent to the sftp server per write
+OUTPUT_QUEUE_BATCHES = 64  # batches of output lines that can be waiting for the background file writer before the processing has to wait for it
+METRICS_JSON_FILE = 'counselor_metrics.json'  # phase timings and student counts of the last run, for monitoring
+METRICS_PROMETHEUS_FILE = 'counselor_metrics.prom'  # the same metrics in the Prometheus textfile format, point node_exporter's textfile collector at this directory to pick it up
+CHANGE_REPORT_JSON_FILE = 'counselor_changes.json'  # full change summary written by --dry-run
+CHANGE_REPORT_CSV_FILE = 'counselor_changes.csv'  # students gained and lost by each staff member, written by --dry-run
 IGNORED_SCHOOLS = [5]  # school codes from powerschool that will be ignored
+FETCH_ARRAYSIZE = 1000  # number of student rows pulled from the database per round trip while streaming the query results
+FETCH_PREFETCHROWS = 1000  # number of student rows returned along with the query execution so the first batch does not need its own round trip
+HS_CASELOAD_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hs_caseloads.json')  # config file with the last name ranges for the high school staff
+STATE_FILE_NAME = 'counselor_state.db'  # local sqlite file holding the snapshot of each student's last assignment for incremental runs
+HS_GRADES = range(9, 13)  # grade levels that are processed as high schoolers by last name
 
-# store the guidance counselor names as environment variables for privacy
-WHS_GUIDANCE_1 = os.environ.get('WHS_GUIDANCE_1')
-WHS_GUIDANCE_1_EMAIL = os.environ.get('WHS_GUIDANCE_1_EMAIL')
-WHS_GUIDANCE_2 = os.environ.get('WHS_GUIDANCE_2')
-WHS_GUIDANCE_2_EMAIL = os.environ.get('WHS_GUIDANCE_2_EMAIL')
-WHS_GUIDANCE_3 = os.environ.get('WHS_GUIDANCE_3')
-WHS_GUIDANCE_3_EMAIL = os.environ.get('WHS_GUIDANCE_3_EMAIL')
-WHS_GUIDANCE_4 = os.environ.get('WHS_GUIDANCE_4')
-WHS_GUIDANCE_4_EMAIL = os.environ.get('WHS_GUIDANCE_4_EMAIL')
-WHS_GUIDANCE_5 = os.environ.get('WHS_GUIDANCE_5')
-WHS_GUIDANCE_5_EMAIL = os.environ.get('WHS_GUIDANCE_5_EMAIL')
+STUDENT_COLUMNS = 'stu.student_number, stu.last_name, stu.grade_level, stu.enroll_status, stu.schoolid, stufields.custom_counselor, stufields.custom_deans_house, stuext.custom_social, stuext.custom_psych, stufields.custom_counselor_email, stuext.academy, stuext.ils, stufields.custom_deans_house_email, stufields.custom_social_email, stufields.custom_psych_email'
+STUDENT_TABLES = 'students stu LEFT JOIN u_studentsuserfields stufields ON stu.dcid = stufields.studentsdcid LEFT JOIN u_def_ext_students0 stuext ON stu.dcid = stuext.studentsdcid'
+MODIFIED_SINCE_FILTER = 'stu.transaction_date >= :since OR stufields.whenmodified >= :since OR stuext.whenmodified >= :since'  # students whose record or custom fields have been changed since the :since bind
+
+# store the guidance counselor names as environment variables for privacy. The high school staff that are split by last name are listed in HS_CASELOAD_FILE by their environment variable name
 WHS_GUIDANCE_ACADEMY = os.environ.get('WHS_GUIDANCE_ACADEMY')
 WHS_GUIDANCE_ACADEMY_EMAIL = os.environ.get('WHS_GUIDANCE_ACADEMY_EMAIL')
 WMS_GUIDANCE = os.environ.get('WMS_GUIDANCE')
@@ -53,263 +80,1004 @@ WMS_PSYCH = os.environ.get('WMS_PSYCH')
 WMS_PSYCH_EMAIL = os.environ.get('WMS_PSYCH_EMAIL')
 MMS_PSYCH = os.environ.get('MMS_PSYCH')
 MMS_PSYCH_EMAIL = os.environ.get('MMS_PSYCH_EMAIL')
-WHS_PSYCH_1 = os.environ.get('WHS_PSYCH_1')
-WHS_PSYCH_1_EMAIL = os.environ.get('WHS_PSYCH_1_EMAIL')
-WHS_PSYCH_2 = os.environ.get('WHS_PSYCH_2')
-WHS_PSYCH_2_EMAIL = os.environ.get('WHS_PSYCH_2_EMAIL')
 WMS_SOCIAL = os.environ.get('WMS_SOCIAL')
 WMS_SOCIAL_EMAIL = os.environ.get('WMS_SOCIAL_EMAIL')
 MMS_SOCIAL = os.environ.get('MMS_SOCIAL')
 MMS_SOCIAL_EMAIL = os.environ.get('MMS_SOCIAL_EMAIL')
-WHS_SOCIAL_1 = os.environ.get('WHS_SOCIAL_1')
-WHS_SOCIAL_1_EMAIL = os.environ.get('WHS_SOCIAL_1_EMAIL')
-WHS_SOCIAL_2 = os.environ.get('WHS_SOCIAL_2')
-WHS_SOCIAL_2_EMAIL = os.environ.get('WHS_SOCIAL_2_EMAIL')
 WHS_SOCIAL_3 = os.environ.get('WHS_SOCIAL_3')
 WHS_SOCIAL_3_EMAIL = os.environ.get('WHS_SOCIAL_3_EMAIL')
 WHS_SOCIAL_ACADEMY = os.environ.get('WHS_SOCIAL_ACADEMY')
 WHS_SOCIAL_ACADEMY_EMAIL = os.environ.get('WHS_SOCIAL_ACADEMY_EMAIL')
 WHS_SOCIAL_ILS = os.environ.get('WHS_SOCIAL_ILS')
 WHS_SOCIAL_ILS_EMAIL = os.environ.get('WHS_SOCIAL_ILS_EMAIL')
-WHS_DEAN_1 = os.environ.get('WHS_DEAN_1')
-WHS_DEAN_1_EMAIL = os.environ.get('WHS_DEAN_1_EMAIL')
-WHS_DEAN_2 = os.environ.get('WHS_DEAN_2')
-WHS_DEAN_2_EMAIL = os.environ.get('WHS_DEAN_2_EMAIL')
 
-print(f"Database Username: {DB_UN} |Password: {DB_PW} |Server: {DB_CS}")  # debug so we can see where oracle is trying to connect to/with
-print(f'SFTP Username: {SFTP_UN} | D118 SFTP Password: {SFTP_PW} | D118 SFTP Server: {SFTP_HOST}')  # debug so we can see what info sftp connection is using
+
+logger = logging.getLogger('counselors')
+logging.addLevelName(logging.DEBUG, 'DBUG')  # keep the same message prefixes the log has always used
+logging.addLevelName(logging.WARNING, 'WARN')
+
+Assignment = namedtuple('Assignment', ['counselor', 'counselorEmail', 'dean', 'deanEmail', 'social', 'socialEmail', 'psych', 'psychEmail'])  # the full set of student services staff for a student, shared between every student with the same staff
+STAFF_FIELD_NAMES = ['counselor', 'counselor email', 'dean', 'dean email', 'social worker', 'social worker email', 'psychologist', 'psychologist email']  # how each Assignment field is described in the change warnings
+BLANK_ASSIGNMENT = Assignment('', '', '', '', '', '', '', '')  # inactive and elementary students get all their fields blanked out
+MIDDLE_SCHOOL_ASSIGNMENTS = {  # school code to the staff for the middle schools, where every student in the building has the same staff
+    1003: Assignment(WMS_GUIDANCE, WMS_GUIDANCE_EMAIL, '', '', WMS_SOCIAL, WMS_SOCIAL_EMAIL, WMS_PSYCH, WMS_PSYCH_EMAIL),
+    1004: Assignment(MMS_GUIDANCE, MMS_GUIDANCE_EMAIL, '', '', MMS_SOCIAL, MMS_SOCIAL_EMAIL, MMS_PSYCH, MMS_PSYCH_EMAIL),
+}
+
+
+def high_school_variants(base):
+    """Take the assignment for a high school last name range and return the versions of it for regular, ILS, academy, and academy + ILS students, in that order so they can be indexed by isAcademy * 2 + isILS."""
+    academy = base._replace(counselor=WHS_GUIDANCE_ACADEMY, counselorEmail=WHS_GUIDANCE_ACADEMY_EMAIL, social=WHS_SOCIAL_ACADEMY, socialEmail=WHS_SOCIAL_ACADEMY_EMAIL)  # academy students get their own counselor and social worker
+    return (base, base._replace(social=WHS_SOCIAL_ILS, socialEmail=WHS_SOCIAL_ILS_EMAIL), academy, academy._replace(social=WHS_SOCIAL_ILS, socialEmail=WHS_SOCIAL_ILS_EMAIL))  # ILS overrides the social worker even for academy students
+
+
+HS_ERROR_ASSIGNMENTS = high_school_variants(BLANK_ASSIGNMENT._replace(counselor='ERROR'))  # used for last names that fall outside every range in the caseload file
+
+
+def compile_hs_caseloads(fileName):
+    """Load the high school caseload config file and compile it into a sorted list of range starting points to search with bisect, and the assignment variants for each of those ranges.
+
+    Each range in the file has the (lowercase) last name it starts at and the environment variable names of its counselor, dean, social worker and psychologist, with the emails coming from the same name plus _EMAIL.
+    Each range runs until the next one starts, and the last range runs until the "end" value. Names before the first range or at/after the end get the ERROR assignment.
+    Raises ValueError if two ranges start at the same name or the end is not after the last start, so a bad re-split stops the script instead of misassigning students.
+    """
+    with open(fileName) as configFile:
+        config = json.load(configFile)
+    starts = []
+    assignments = []
+    for caseload in sorted(config['ranges'], key=lambda caseload: caseload['start'].lower()):  # sort on the lowercase start since that is what the last names are compared against
+        start = caseload['start'].lower()
+        if starts and start == starts[-1]:
+            raise ValueError(f'{fileName} has more than one caseload range starting at "{start}"')
+        staff = []
+        for role in ['counselor', 'dean', 'social', 'psych']:
+            staff.append(os.environ.get(caseload[role]))
+            staff.append(os.environ.get(caseload[role] + '_EMAIL'))
+        starts.append(start)
+        assignments.append(high_school_variants(Assignment(*staff)))
+    if not starts or starts[0] != '':  # make sure every name lands in a range, even if it is just the error one
+        starts.insert(0, '')
+        assignments.insert(0, HS_ERROR_ASSIGNMENTS)
+    end = config['end'].lower()
+    if end <= starts[-1]:
+        raise ValueError(f'{fileName} has an end of "{end}" that is not after the last caseload range start "{starts[-1]}"')
+    starts.append(end)
+    assignments.append(HS_ERROR_ASSIGNMENTS)
+    return starts, assignments
+
+
+HS_RANGE_STARTS, HS_RANGE_ASSIGNMENTS = compile_hs_caseloads(HS_CASELOAD_FILE)  # compiled once at startup so each student only needs one bisect to find their staff
+RULES_FINGERPRINT = hashlib.sha256(repr((HS_GRADES, HS_RANGE_STARTS, HS_RANGE_ASSIGNMENTS, MIDDLE_SCHOOL_ASSIGNMENTS, BLANK_ASSIGNMENT, IGNORED_SCHOOLS)).encode()).hexdigest()  # changes whenever the caseloads, any staff name or the ignored schools do, which invalidates the snapshot
+
+
+class StaffCodes:
+    """Dictionary encoding of staff names and emails to small integers, so the columnar batch mode can store and compare them as integers instead of strings.
+
+    Codes are handed out the first time a value is seen and are kept for the whole run, so every batch (and every worker thread) shares the same codes. A blank value is always code 0.
+    """
+
+    def __init__(self):
+        self.codes = {'': 0}  # value to code
+        self.values = ['']  # code to value
+        self.lock = threading.Lock()  # new codes can be added by several worker threads at once
+
+    def encode(self, value):
+        """Return the code for a single value, adding it if it has not been seen before."""
+        code = self.codes.get(value)
+        if code is None:
+            with self.lock:
+                code = self.codes.get(value)
+                if code is None:  # add the value before its code, since other threads read codes without the lock and then look the code up in values
+                    code = len(self.values)
+                    self.values.append(value)
+                    self.codes[value] = code
+        return code
+
+    def encode_column(self, column):
+        """Return an array of the codes for a column of staff values from the database, where None is treated as blank the same way parse_student() does."""
+        codes = self.codes
+        try:
+            return array('l', [codes[value or ''] for value in column])  # every value is normally one we have already seen
+        except KeyError:
+            return array('l', [self.encode(value or '') for value in column])
+
+
+def compile_assignment_table():
+    """Put every distinct Assignment in one table so the columnar batch mode can refer to a student's new staff by a small integer.
+
+    Returns the table, the index of each middle school's assignment, the index the high school assignments start at (so a high schooler's is that plus rangeIndex * 4 + isAcademy * 2 + isILS),
+    and the set of indexes that are the ERROR assignments.
+    """
+    table = [BLANK_ASSIGNMENT]
+    middleSchoolIndexes = {}
+    for school, assignment in MIDDLE_SCHOOL_ASSIGNMENTS.items():
+        middleSchoolIndexes[school] = len(table)
+        table.append(assignment)
+    highSchoolStart = len(table)
+    errorIndexes = set()
+    for variants in HS_RANGE_ASSIGNMENTS:
+        if variants is HS_ERROR_ASSIGNMENTS:
+            errorIndexes.update(range(len(table), len(table) + len(variants)))
+        table.extend(variants)
+    return table, middleSchoolIndexes, highSchoolStart, errorIndexes
+
+
+STAFF_CODES = StaffCodes()
+ASSIGNMENT_TABLE, MIDDLE_SCHOOL_INDEXES, HS_ASSIGNMENT_START, ERROR_ASSIGNMENT_INDEXES = compile_assignment_table()
+ASSIGNMENT_FIELD_CODES = [array('l', [STAFF_CODES.encode(assignment[field]) for assignment in ASSIGNMENT_TABLE]) for field in range(len(Assignment._fields))]  # for each Assignment field, the code of its value in each entry of ASSIGNMENT_TABLE
+ASSIGNMENT_CODES = list(zip(*ASSIGNMENT_FIELD_CODES))  # the codes of every field of each entry of ASSIGNMENT_TABLE, compared against a student's stored codes in one go
+ASSIGNMENT_LINES = [f'\t{a.counselor}\t{a.dean}\t{a.social}\t{a.psych}\t{a.counselorEmail}\t{a.deanEmail}\t{a.socialEmail}\t{a.psychEmail}' for a in ASSIGNMENT_TABLE]  # everything after the student number in the output line
+SKIPPED_STUDENT = -1  # assignment index used in the columnar batch mode for students the snapshot says can be skipped
+FAILED_STUDENT = -2  # assignment index used in the columnar batch mode for students that hit an error and are left out, like assign_batch() does
+
+
+def student_filters(since=None, schoolid=None):
+    """Build the WHERE clause and its binds that limit a student query to the students modified since a time (for incremental runs) and/or in a single school (for parallel runs), either of which can be left out."""
+    clauses = []
+    binds = {}
+    if since is not None:
+        clauses.append(f'({MODIFIED_SINCE_FILTER})')
+        binds['since'] = since
+    if schoolid is not None:
+        clauses.append('stu.schoolid = :schoolid')
+        binds['schoolid'] = schoolid
+    return (f'WHERE {" AND ".join(clauses)}' if clauses else ''), binds
+
+
+def build_student_query(since=None, schoolid=None):
+    """Build the normal student query that returns every student along with their current staff fields, newest student number first, filtered by student_filters(). Returns the query text and its binds."""
+    where, binds = student_filters(since, schoolid)
+    return f'SELECT {STUDENT_COLUMNS} FROM {STUDENT_TABLES} {where} ORDER BY stu.student_number DESC', binds
+
+
+def build_server_diff_query(since=None, schoolid=None):
+    """Build the query used for server side diff mode, which works out each student's assignment in SQL from the same caseload table and middle school staff as process_student, and only returns students where it differs from what is stored.
+
+    since and schoolid limit which students are considered the same way as build_student_query().
+    The innermost select finds each student's category and the index of their high school assignment variant (last name range * 4 + academy * 2 + ILS), the middle select turns those into the staff for each field,
+    and the outer select compares them to the stored values with DECODE since it treats two nulls as equal (PowerSchool stores blank fields as null). Returns the query text and the dictionary of bind variables.
+    """
+    where, binds = student_filters(since, schoolid)
+    bindNames = {}  # staff value to bind variable name, so each distinct name or email is only sent once
+
+    def bind(value):
+        if value not in bindNames:
+            bindNames[value] = f'v{len(bindNames)}'
+            binds[bindNames[value]] = value
+        return ':' + bindNames[value]
+
+    rangeCases = []
+    for index, start in enumerate(HS_RANGE_STARTS[1:]):  # a name before the start of range n + 1 is in range n
+        binds[f'r{index}'] = start
+        rangeCases.append(f'WHEN LOWER(stu.last_name) < :r{index} THEN {index}')
+    rangeCase = f'CASE {" ".join(rangeCases)} ELSE {len(HS_RANGE_STARTS) - 1} END'
+    hsKey = f"({rangeCase}) * 4 + CASE WHEN stuext.academy = 1 THEN 2 ELSE 0 END + CASE WHEN stuext.ils = 1 THEN 1 ELSE 0 END"
+
+    newFields = []
+    comparisons = []
+    storedColumns = ['custom_counselor', 'custom_counselor_email', 'custom_deans_house', 'custom_deans_house_email', 'custom_social', 'custom_social_email', 'custom_psych', 'custom_psych_email']  # in the same order as the Assignment fields
+    for field, storedColumn in enumerate(storedColumns):
+        hsCases = ' '.join(f'WHEN {index * 4 + variant} THEN {bind(assignment[field])}' for index, variants in enumerate(HS_RANGE_ASSIGNMENTS) for variant, assignment in enumerate(variants))
+        msCases = ' '.join(f'WHEN {school} THEN {bind(assignment[field])}' for school, assignment in MIDDLE_SCHOOL_ASSIGNMENTS.items())
+        newFields.append(f"CASE WHEN category = 'HS' THEN CASE hs_key {hsCases} END WHEN category = 'MS' THEN CASE schoolid {msCases} END END AS new_{field}")
+        comparisons.append(f'DECODE(new_{field}, {storedColumn}, 0, 1) = 1')
+
+    columns = ', '.join(column.split('.')[1] for column in STUDENT_COLUMNS.split(', '))
+    query = f"""SELECT {columns} FROM (
+    SELECT base.*, {', '.join(newFields)} FROM (
+        SELECT {STUDENT_COLUMNS},
+            CASE WHEN stu.grade_level BETWEEN {HS_GRADES[0]} AND {HS_GRADES[-1]} AND stu.enroll_status = 0 THEN 'HS' WHEN stu.schoolid IN ({', '.join(str(school) for school in MIDDLE_SCHOOL_ASSIGNMENTS)}) AND stu.enroll_status = 0 THEN 'MS' END AS category,
+            {hsKey} AS hs_key
+        FROM {STUDENT_TABLES} {where}
+    ) base
+) WHERE {' OR '.join(comparisons)}
+ORDER BY student_number DESC"""
+    return query, binds
+
+
+class BufferedStreamHandler(logging.StreamHandler):
+    """StreamHandler that leaves it up to the stream's own buffer when to write, instead of flushing after every message like the normal one does."""
+
+    def flush(self):
+        pass
+
+
+@contextmanager
+def run_logging(logFile, level):
+    """Send log messages at or above level to both the console and logFile, through a queue so the actual writes happen on a background thread instead of holding up processing.
+
+    The listener is stopped on the way out, which writes out anything still in the queue.
+    """
+    logQueue = queue.SimpleQueue()
+    formatter = logging.Formatter('%(levelname)s: %(message)s')
+    outputs = [logging.StreamHandler(sys.stdout), BufferedStreamHandler(logFile)]
+    for output in outputs:
+        output.setFormatter(formatter)
+    queueHandler = QueueHandler(logQueue)
+    logger.addHandler(queueHandler)
+    logger.setLevel(level)
+    logger.propagate = False
+    listener = QueueListener(logQueue, *outputs)
+    listener.start()
+    try:
+        yield
+    finally:
+        listener.stop()
+        logger.removeHandler(queueHandler)
+
+
+def student_fingerprint(last, grade, enroll, school, isAcademy, isILS):
+    """Return a short hash of the fields that decide a student's staff, so we can tell if any of them have changed since the last run."""
+    return hashlib.blake2b(f'{last}\t{grade}\t{enroll}\t{school}\t{isAcademy}\t{isILS}'.encode(), digest_size=8).hexdigest()
+
+
+class AssignmentSnapshot:
+    """Local sqlite snapshot of the staff assignment last computed for each student along with the fingerprint of the fields it was computed from.
+
+    Also stores the database time the last successful run started and the RULES_FINGERPRINT it was run with. All changes are made in a single transaction that is only committed by save(),
+    so a run that fails part way through leaves the previous snapshot untouched and the next run will pick up the same students again.
+    """
+
+    def __init__(self, fileName):
+        self.db = sqlite3.connect(fileName, check_same_thread=False)  # the worker threads in parallel mode all share the snapshot
+        self.lock = threading.Lock()  # so only one thread uses the connection at a time
+        self.db.execute('CREATE TABLE IF NOT EXISTS assignments (student_number INTEGER PRIMARY KEY, fingerprint TEXT, counselor TEXT, counselor_email TEXT, dean TEXT, dean_email TEXT, social TEXT, social_email TEXT, psych TEXT, psych_email TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.commit()
+        self.cleared = False  # set once the students are cleared for a full run, when there is nothing to look up
+
+    def last_run(self):
+        """Return the database time the last successful run started, or None if there was no successful run or it used different caseloads or staff than this one."""
+        meta = dict(self.db.execute('SELECT key, value FROM meta'))
+        if 'last_run' not in meta or meta.get('rules') != RULES_FINGERPRINT:
+            return None
+        return datetime.fromisoformat(meta['last_run'])
+
+    def clear(self):
+        """Remove every student from the snapshot, used for full rebuilds so students that no longer come back from PowerSchool do not linger."""
+        self.db.execute('DELETE FROM assignments')
+        self.cleared = True
+
+    def unchanged(self, stuID, fingerprint, current):
+        """Return True if the student has the same fingerprint as last run and their current PowerSchool values still match the assignment we computed for them then."""
+        if self.cleared:  # full run, so no student can be in the snapshot yet
+            return False
+        with self.lock:
+            previous = self.db.execute('SELECT fingerprint, counselor, counselor_email, dean, dean_email, social, social_email, psych, psych_email FROM assignments WHERE student_number = ?', (stuID,)).fetchone()
+        return previous is not None and previous[0] == fingerprint and Assignment(*previous[1:]) == current
+
+    def record(self, stuID, fingerprint, assignment):
+        """Store the newly computed assignment for a student."""
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO assignments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (stuID, fingerprint, *assignment))
+
+    def save(self, runStarted):
+        """Commit all the recorded assignments along with the time this run started and the rules it used."""
+        self.db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [('last_run', runStarted.isoformat()), ('rules', RULES_FINGERPRINT)])
+        self.db.commit()
+
+    def close(self):
+        """Close the snapshot database, throwing away any changes that were not saved."""
+        self.db.rollback()
+        self.db.close()
+
+
+class RunMetrics:
+    """High resolution timings of each phase of a run and counts of how the students were handled, which are exported at the end of the run so slowdowns can be alerted on.
+
+    Safe to share between the worker threads of a parallel run.
+    """
+
+    def __init__(self):
+        self.started = datetime.now()
+        self.startCounter = perf_counter()
+        self.phases = Counter()  # phase name to total seconds spent in it
+        self.counts = Counter()  # student category to number of students
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager that adds the time spent inside it to the named phase."""
+        phaseStart = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, perf_counter() - phaseStart)
+
+    def add_phase(self, name, elapsed):
+        """Add an already measured time to the named phase."""
+        with self.lock:
+            self.phases[name] += elapsed
+
+    def add_counts(self, counts):
+        """Add a dictionary of category counts, done once per batch so the lock is not taken for every student."""
+        with self.lock:
+            self.counts.update(counts)
+
+    def summary(self):
+        """Return the metrics as a dictionary that can be written out as json."""
+        return {'started': self.started.isoformat(timespec='seconds'), 'total_seconds': round(perf_counter() - self.startCounter, 6),
+                'phase_seconds': {phase: round(seconds, 6) for phase, seconds in self.phases.items()}, 'students': dict(self.counts)}
+
+    def export(self, jsonFileName, prometheusFileName):
+        """Write the metrics to a json file and a Prometheus textfile. Each is written to a temporary file first and then moved into place so a reader never sees half a file."""
+        summary = self.summary()
+        with open(jsonFileName + '.tmp', 'w') as jsonFile:
+            json.dump(summary, jsonFile, indent=4)
+        os.replace(jsonFileName + '.tmp', jsonFileName)
+        lines = ['# HELP counselors_run_seconds Total time the last run took', '# TYPE counselors_run_seconds gauge', f'counselors_run_seconds {summary["total_seconds"]}',
+                 '# HELP counselors_last_run_timestamp_seconds When the last run started', '# TYPE counselors_last_run_timestamp_seconds gauge', f'counselors_last_run_timestamp_seconds {self.started.timestamp():.0f}',
+                 '# HELP counselors_phase_seconds Time the last run spent in each phase', '# TYPE counselors_phase_seconds gauge']
+        lines.extend(f'counselors_phase_seconds{{phase="{phase}"}} {seconds}' for phase, seconds in summary['phase_seconds'].items())
+        lines.extend(['# HELP counselors_students Number of students in the last run by how they were handled', '# TYPE counselors_students gauge'])
+        lines.extend(f'counselors_students{{category="{category}"}} {count}' for category, count in summary['students'].items())
+        with open(prometheusFileName + '.tmp', 'w') as prometheusFile:
+            prometheusFile.write('\n'.join(lines) + '\n')
+        os.replace(prometheusFileName + '.tmp', prometheusFileName)
+
+
+class ChangeReport:
+    """Summary of the changes a run would make, for the --dry-run preview.
+
+    Every changed student is counted in a single map keyed by their school and their old and new Assignment. Even a start of year rebalance only has a few hundred distinct moves,
+    so adding a student is one dictionary update and the per staff, per field and per school totals are worked out from those moves at the end.
+    Safe to share between the worker threads of a parallel run.
+    """
+
+    def __init__(self):
+        self.moves = Counter()  # (school, old Assignment, new Assignment) to number of students
+        self.lock = threading.Lock()
+
+    def add_moves(self, moves):
+        """Add a dictionary of move counts, done once per batch so the lock is not taken for every student."""
+        with self.lock:
+            self.moves.update(moves)
+
+    def summary(self):
+        """Return the changed student totals, the number of students changing in each field and school, the students gained and lost by each staff member, and every staff change from one person to another."""
+        fields = Counter()
+        schools = Counter()
+        gained = Counter()  # (role, staff name) to number of students
+        lost = Counter()
+        roleMoves = Counter()  # (role, old staff name, new staff name) to number of students
+        for (school, old, new), count in self.moves.items():
+            schools[school] += count
+            for field, oldValue, newValue in zip(Assignment._fields, old, new):
+                if oldValue != newValue:
+                    fields[field] += count
+            for role, oldValue, newValue in zip(Assignment._fields[::2], old[::2], new[::2]):  # the even fields are the staff names, the odd ones their emails
+                if oldValue != newValue:
+                    roleMoves[(role, oldValue, newValue)] += count
+                    if newValue:
+                        gained[(role, newValue)] += count
+                    if oldValue:
+                        lost[(role, oldValue)] += count
+        staff = [{'role': role, 'staff': name, 'gained': gained[(role, name)], 'lost': lost[(role, name)], 'net': gained[(role, name)] - lost[(role, name)]} for role, name in sorted(gained.keys() | lost.keys(), key=lambda key: (key[0], str(key[1])))]
+        return {'students_changed': sum(schools.values()), 'fields': dict(fields), 'schools': {str(school): count for school, count in sorted(schools.items())}, 'staff': staff,
+                'moves': [{'role': role, 'from': old, 'to': new, 'students': count} for (role, old, new), count in roleMoves.most_common()]}
+
+    def export(self, jsonFileName, csvFileName):
+        """Write the full summary to a json file and the per staff member totals to a csv file. Returns the summary."""
+        summary = self.summary()
+        with open(jsonFileName, 'w') as jsonFile:
+            json.dump(summary, jsonFile, indent=4)
+        with open(csvFileName, 'w', newline='') as csvFile:
+            writer = csv.DictWriter(csvFile, fieldnames=['role', 'staff', 'gained', 'lost', 'net'])
+            writer.writeheader()
+            writer.writerows(summary['staff'])
+        return summary
+
+
+def fetch_student_batches(cur):
+    """Generator that yields the student query results in batches of FETCH_ARRAYSIZE rows so the whole student table is never held in memory at once."""
+    while True:
+        rows = cur.fetchmany(FETCH_ARRAYSIZE)
+        if not rows:  # an empty batch means the cursor is exhausted
+            break
+        yield rows
+
+
+def parse_student(student):
+    """Turn a row from the student query into the fields used to find and compare their staff.
+
+    Returns a tuple of (stuID, last, grade, enroll, school, isAcademy, isILS, current) where current is an Assignment of the staff PowerSchool has for them right now.
+    """
+    stuID = int(student[0])
+    last = str(student[1]).lower()
+    grade = int(student[2])
+    enroll = int(student[3])
+    school = int(student[4])
+    currentCounselor = str(student[5]) if student[5] else ''
+    currentCounselorEmail = str(student[9]) if student[9] else ''
+    currentDean = str(student[6]) if student[6] else ''
+    currentDeanEmail = str(student[12]) if student[12] else ''
+    currentSocial = str(student[7]) if student[7] else ''
+    currentSocialEmail = str(student[13]) if student[13] else ''
+    currentPsych = str(student[8]) if student[8] else ''
+    currentPsychEmail = str(student[14]) if student[14] else ''
+    isAcademy = True if student[10] == 1 else False
+    isILS = True if student[11] == 1 else False
+    current = Assignment(currentCounselor, currentCounselorEmail, currentDean, currentDeanEmail, currentSocial, currentSocialEmail, currentPsych, currentPsychEmail)
+    return stuID, last, grade, enroll, school, isAcademy, isILS, current
+
+
+def find_assignment(stuID, last, grade, enroll, school, isAcademy, isILS):
+    """Find the staff a student should have based on their grade, enrollment and school, and for high schoolers their last name, academy and ILS status.
+
+    Returns the category they were processed as (high_school, middle_school, blanked, or error if their last name was outside the caseload ranges) and the shared Assignment record.
+    """
+    if grade in HS_GRADES and enroll == 0:  # process high schoolers
+        logger.debug('%s: %s is in grade %s and active, will process as a high schooler', stuID, last, grade)
+        rangeIndex = bisect_right(HS_RANGE_STARTS, last) - 1  # find the last range that starts at or before their last name
+        category = 'high_school'
+        if HS_RANGE_ASSIGNMENTS[rangeIndex] is HS_ERROR_ASSIGNMENTS:  # just in case their name is outside all the ranges
+            logger.error('%s: Student last name processing failed', stuID)
+            category = 'error'
+        if isAcademy:
+            logger.debug('%s: Student is an academy student, overriding their counselor and social worker', stuID)
+        if isILS:
+            logger.debug('%s: Student is an ILS student, overriding their social worker', stuID)
+        return category, HS_RANGE_ASSIGNMENTS[rangeIndex][isAcademy * 2 + isILS]  # pick the academy/ILS override version if needed
+    elif school in MIDDLE_SCHOOL_ASSIGNMENTS and enroll == 0:  # if they are a middle schooler they all have the same counselor per building
+        logger.debug('%s: %s is in grade %s at building %s and is active, will process as a middle schooler', stuID, last, grade, school)
+        return 'middle_school', MIDDLE_SCHOOL_ASSIGNMENTS[school]
+    else:  # if they are not in 6-12 or are not active, blank out all their fields
+        logger.debug('%s has a grade level of %s at school %s and enroll status of %s, so they will be set to blanks', stuID, grade, school, enroll)
+        return 'blanked', BLANK_ASSIGNMENT
+
+
+def diff_student(stuID, grade, enroll, school, assignment, current):
+    """Compare the staff a student should have to what PowerSchool currently has, and return the line for the output file if anything has changed, or None if it has not."""
+    counselor, counselorEmail, dean, deanEmail, social, socialEmail, psych, psychEmail = assignment
+    logger.debug('%s in grade %s at school %s- Counselor: %s-%s | Dean: %s-%s | Social Worker: %s-%s | Psychologist: %s-%s', stuID, grade, school, counselor, counselorEmail, dean, deanEmail, social, socialEmail, psych, psychEmail)
+    if assignment == current:  # nothing to change, which is the case for almost every student on a normal night
+        return None
+
+    # check to see which of their counselor, dean, psychologist or social worker changed from the current value, warn if they are changing from other values and are enrolled as a sanity check
+    if enroll == 0:
+        for fieldName, new, old in zip(STAFF_FIELD_NAMES, assignment, current):
+            if new != old and old != '':
+                logger.warning(f'{stuID} is changing from the {fieldName} of {old} to {new}')
+
+    return f'{stuID}\t{counselor}\t{dean}\t{social}\t{psych}\t{counselorEmail}\t{deanEmail}\t{socialEmail}\t{psychEmail}'
+
+
+def assign_batch(batch, snapshot=None, metrics=None):
+    """Parse a batch of rows from the student query and find the staff each student should have. Returns a list of (parsed student, assignment) pairs to pass to diff_batch().
+
+    If an AssignmentSnapshot is passed, students whose fingerprint and current values match it are skipped entirely, and the new assignment for everyone else is recorded in it.
+    If RunMetrics are passed, the number of students in each category are added to them.
+    """
+    counts = Counter()
+    assigned = []
+    for student in batch:
+        try:
+            parsed = parse_student(student)
+            stuID, last, grade, enroll, school, isAcademy, isILS, current = parsed
+            if snapshot is not None:
+                fingerprint = student_fingerprint(last, grade, enroll, school, isAcademy, isILS)
+                if snapshot.unchanged(stuID, fingerprint, current):  # nothing that decides their staff has changed and PowerSchool already has what we assigned last time
+                    counts['skipped_unchanged'] += 1
+                    continue
+            category, assignment = find_assignment(stuID, last, grade, enroll, school, isAcademy, isILS)
+            counts[category] += 1
+            if snapshot is not None:
+                snapshot.record(stuID, fingerprint, assignment)
+            assigned.append((parsed, assignment))
+        except Exception as er:
+            logger.error(f'Error while processing student {student[0]}: {er}')
+            counts['error'] += 1
+    if metrics is not None:
+        metrics.add_counts(counts)
+    return assigned
+
+
+def diff_batch(assigned, metrics=None, report=None):
+    """Compare each student from assign_batch() to their current staff, and return the list of output lines for the ones that have changed, leaving out students in the ignored schools.
+
+    If RunMetrics are passed, the number of changed and ignored students are added to them, and if a ChangeReport is passed the changed students are added to it.
+    """
+    counts = Counter()
+    moves = Counter()
+    lines = []
+    for parsed, assignment in assigned:
+        try:
+            stuID, last, grade, enroll, school, isAcademy, isILS, current = parsed
+            line = diff_student(stuID, grade, enroll, school, assignment, current)
+            if line is None:
+                continue
+            # do the final output to the text file only if there is change in any of the values for the student
+            if school not in IGNORED_SCHOOLS:
+                lines.append(line)
+                counts['changed'] += 1
+                if report is not None:
+                    moves[(school, current, assignment)] += 1
+            else:
+                logger.warning(f'{stuID} is marked that information needs to be changed but will not be because they are in the ignored school code {school}')
+                counts['ignored_school'] += 1
+        except Exception as er:
+            logger.error(f'Error while comparing staff for student {parsed[0]}: {er}')
+            counts['error'] += 1
+    if metrics is not None:
+        metrics.add_counts(counts)
+    if report is not None:
+        report.add_moves(moves)
+    return lines
+
+
+CURRENT_STAFF_COLUMNS = [5, 9, 6, 12, 7, 13, 8, 14]  # positions of the stored staff fields in the student query, in Assignment field order
+
+
+def pack_bits(values):
+    """Pack a column of 0/1 flags from the database into a bit array, one bit per student."""
+    bits = bytearray((len(values) + 7) // 8)
+    for index, value in enumerate(values):
+        if value == 1:
+            bits[index >> 3] |= 1 << (index & 7)
+    return bits
+
+
+def unpack_bits(bits, count):
+    """Return the first count flags of a bit array from pack_bits() as a list of 0 and 1."""
+    return [bits[index >> 3] >> (index & 7) & 1 for index in range(count)]
+
+
+class StudentColumns:
+    """Columnar version of a batch of rows from the student query, used by the columnar batch mode.
+
+    The numeric fields are stored in typed arrays, the academy and ILS flags in bit arrays, and the stored staff names and emails as STAFF_CODES so they can be compared as integers.
+    """
+
+    def __init__(self, rows):
+        columns = list(zip(*rows)) or [()] * 15
+        self.studentNumbers = array('q', map(int, columns[0]))
+        self.lastNames = [str(last).lower() for last in columns[1]]
+        self.grades = array('h', map(int, columns[2]))
+        self.enrolls = array('h', map(int, columns[3]))
+        self.schools = array('l', map(int, columns[4]))
+        self.academy = pack_bits(columns[10])
+        self.ils = pack_bits(columns[11])
+        self.staff = [STAFF_CODES.encode_column(columns[position]) for position in CURRENT_STAFF_COLUMNS]  # one column of codes per Assignment field
+
+    def __len__(self):
+        return len(self.studentNumbers)
+
+    @classmethod
+    def from_rows(cls, batch, counts):
+        """Build the columns for a batch of rows. If any row cannot be converted, each row is checked on its own and the bad ones are logged, counted as errors and left out."""
+        try:
+            return cls(batch)
+        except (TypeError, ValueError):
+            goodRows = []
+            for student in batch:
+                try:
+                    cls([student])
+                    goodRows.append(student)
+                except (TypeError, ValueError) as er:
+                    logger.error(f'Error while processing student {student[0]}: {er}')
+                    counts['error'] += 1
+            return cls(goodRows)
+
+    def current(self, index):
+        """Decode the stored staff of one student back into an Assignment."""
+        return Assignment(*[STAFF_CODES.values[codes[index]] for codes in self.staff])
+
+
+def assignment_index(last, grade, enroll, school, isAcademy, isILS):
+    """Return the index into ASSIGNMENT_TABLE of the staff a student should have, using the same rules as find_assignment() with high schoolers indexed by their range and academy/ILS variant."""
+    if enroll == 0 and grade in HS_GRADES:
+        return HS_ASSIGNMENT_START + (bisect_right(HS_RANGE_STARTS, last) - 1) * 4 + isAcademy * 2 + isILS
+    return MIDDLE_SCHOOL_INDEXES.get(school, 0) if enroll == 0 else 0
+
+
+def assign_columns(batch, snapshot=None, metrics=None):
+    """Columnar version of assign_batch(), which finds the staff for a whole batch at once. Returns the StudentColumns and an array with the index into ASSIGNMENT_TABLE for each student to pass to diff_columns().
+
+    Does the same snapshot skipping, category counting and per student error handling as assign_batch(), but does not log the debug line for every student.
+    """
+    counts = Counter()
+    columns = StudentColumns.from_rows(batch, counts)
+    count = len(columns)
+    academy = unpack_bits(columns.academy, count)
+    ils = unpack_bits(columns.ils, count)
+    studentColumns = list(zip(columns.lastNames, columns.grades, columns.enrolls, columns.schools, academy, ils))
+    try:
+        targets = array('l', [assignment_index(*student) for student in studentColumns])
+    except Exception:  # find which students failed and leave just them out
+        targets = array('l', [FAILED_STUDENT]) * count
+        for index, student in enumerate(studentColumns):
+            try:
+                targets[index] = assignment_index(*student)
+            except Exception as er:
+                logger.error(f'Error while processing student {columns.studentNumbers[index]}: {er}')
+                counts['error'] += 1
+    if snapshot is not None:
+        for index in range(count):
+            if targets[index] == FAILED_STUDENT:
+                continue
+            stuID = columns.studentNumbers[index]
+            try:
+                fingerprint = student_fingerprint(columns.lastNames[index], columns.grades[index], columns.enrolls[index], columns.schools[index], bool(academy[index]), bool(ils[index]))
+                if snapshot.unchanged(stuID, fingerprint, columns.current(index)):
+                    targets[index] = SKIPPED_STUDENT
+                else:
+                    snapshot.record(stuID, fingerprint, ASSIGNMENT_TABLE[targets[index]])
+            except Exception as er:
+                logger.error(f'Error while processing student {stuID}: {er}')
+                counts['error'] += 1
+                targets[index] = FAILED_STUDENT
+    for target, targetCount in Counter(targets).items():
+        if target == FAILED_STUDENT:  # already counted and logged above
+            continue
+        elif target == SKIPPED_STUDENT:
+            counts['skipped_unchanged'] += targetCount
+        elif target in ERROR_ASSIGNMENT_INDEXES:
+            counts['error'] += targetCount
+            for stuID, studentTarget in zip(columns.studentNumbers, targets):
+                if studentTarget == target:
+                    logger.error('%s: Student last name processing failed', stuID)
+        elif target >= HS_ASSIGNMENT_START:
+            counts['high_school'] += targetCount
+        elif target > 0:
+            counts['middle_school'] += targetCount
+        else:
+            counts['blanked'] += targetCount
+    if metrics is not None:
+        metrics.add_counts(counts)
+    return columns, targets
+
+
+def diff_columns(columns, targets, metrics=None, report=None):
+    """Columnar version of diff_batch(), which compares the codes of each staff field for the whole batch at once, and then builds the output lines and warnings for just the students that changed.
+
+    Students that were skipped or failed in assign_columns() are left out, and an error with any one student is logged and counted without stopping the rest of the batch.
+    """
+    counts = Counter()
+    moves = Counter()
+    lines = []
+    changed = bytearray([ASSIGNMENT_CODES[target] != current for target, current in zip(targets, zip(*columns.staff))])  # 1 for each student with any field code that does not match
+    index = changed.find(1)
+    while index != -1:
+        target = targets[index]
+        if target >= 0:  # not skipped or failed
+            stuID = columns.studentNumbers[index]
+            try:
+                school = columns.schools[index]
+                if columns.enrolls[index] == 0:  # same sanity check warnings as diff_student()
+                    for fieldName, targetCodes, currentCodes in zip(STAFF_FIELD_NAMES, ASSIGNMENT_FIELD_CODES, columns.staff):
+                        if targetCodes[target] != currentCodes[index] and currentCodes[index] != 0:
+                            logger.warning(f'{stuID} is changing from the {fieldName} of {STAFF_CODES.values[currentCodes[index]]} to {STAFF_CODES.values[targetCodes[target]]}')
+                if school not in IGNORED_SCHOOLS:
+                    lines.append(f'{stuID}{ASSIGNMENT_LINES[target]}')
+                    counts['changed'] += 1
+                    if report is not None:
+                        moves[(school, columns.current(index), ASSIGNMENT_TABLE[target])] += 1
+                else:
+                    logger.warning(f'{stuID} is marked that information needs to be changed but will not be because they are in the ignored school code {school}')
+                    counts['ignored_school'] += 1
+            except Exception as er:
+                logger.error(f'Error while comparing staff for student {stuID}: {er}')
+                counts['error'] += 1
+        index = changed.find(1, index + 1)
+    if metrics is not None:
+        metrics.add_counts(counts)
+    if report is not None:
+        report.add_moves(moves)
+    return lines
+
+
+def process_batches(batches, snapshot=None, metrics=None, columnar=False, report=None):
+    """Generator that finds and compares the staff for each batch of student rows from any source (the database cursor normally, or synthetic rows in the benchmark), yielding the number of students in each batch and the output lines from it.
+
+    The time spent fetching, assigning and diffing each batch is added to metrics, which are created if not passed. If columnar is True the batches are processed with assign_columns() and diff_columns().
+    If a ChangeReport is passed the changed students are added to it.
+    """
+    metrics = metrics or RunMetrics()
+    batches = iter(batches)
+    while True:
+        with metrics.phase('fetch'):
+            batch = next(batches, None)
+        if batch is None:
+            break
+        metrics.add_counts({'students': len(batch)})
+        if columnar:
+            with metrics.phase('assign'):
+                columns, targets = assign_columns(batch, snapshot, metrics)
+            with metrics.phase('diff'):
+                lines = diff_columns(columns, targets, metrics, report)
+        else:
+            with metrics.phase('assign'):
+                assigned = assign_batch(batch, snapshot, metrics)
+            with metrics.phase('diff'):
+                lines = diff_batch(assigned, metrics, report)
+        yield len(batch), lines
+
+
+def process_students(cur, query, binds, snapshot, metrics, columnar, report):
+    """Generator that runs a student query on cur and processes the students in batches as they are fetched, yielding the same as process_batches()."""
+    cur.arraysize = FETCH_ARRAYSIZE  # rows per round trip while we iterate the results
+    cur.prefetchrows = FETCH_PREFETCHROWS  # rows that come back with the execute call itself
+    with metrics.phase('query_execute'):
+        cur.execute(query, binds)
+    yield from process_batches(fetch_student_batches(cur), snapshot, metrics, columnar, report)  # process each batch as it comes in instead of loading every student first
+
+
+def build_query(since, serverDiff, schoolid=None):
+    """Build the student query for this run, either the normal one or the server side diff one."""
+    return build_server_diff_query(since, schoolid) if serverDiff else build_student_query(since, schoolid)
+
+
+def database_time(cur):
+    """Return the current time on the database server, which is what the next incremental run needs to compare transaction_date/whenmodified against."""
+    cur.execute('SELECT SYSDATE FROM dual')
+    return cur.fetchone()[0]
+
+
+@contextmanager
+def output_writer(output, metrics):
+    """Context manager that starts a background thread to write the output lines to the output file while the students are still being fetched and processed.
+
+    Yields a function that queues a list of output lines to be written. The queue holds at most OUTPUT_QUEUE_BATCHES lists so the processing can never get too far ahead of the disk.
+    On exit it waits for everything queued to be written, and raises the error if any write failed so the run is not treated as complete.
+    """
+    lineQueue = queue.Queue(maxsize=OUTPUT_QUEUE_BATCHES)
+    errors = []
+
+    def write_lines():
+        while True:
+            lines = lineQueue.get()
+            if lines is None:  # sent once everything has been queued
+                break
+            if errors:  # keep emptying the queue after a failure so the processing does not block on it
+                continue
+            try:
+                with metrics.phase('file_write'):
+                    output.writelines(f'{line}\n' for line in lines)
+            except Exception as er:
+                errors.append(er)
+
+    writer = threading.Thread(target=write_lines, name='output-writer')
+    writer.start()
+    try:
+        yield lineQueue.put
+    finally:
+        lineQueue.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+
+
+def run_serial(since, serverDiff, snapshot, write, metrics, columnar, report):
+    """Process every student over a single database connection, passing the output lines of each batch to write as it comes in. Returns the database time the run started at and the number of students processed."""
+    with metrics.phase('db_connect'):
+        con = oracledb.connect(user=DB_UN, password=DB_PW, dsn=DB_CS)  # create the connecton to the database
+    with con:
+        with con.cursor() as cur:  # start an entry cursor
+            logger.info(f'Connection established to PS database on version: {con.version}')
+            runStarted = database_time(cur)
+            query, binds = build_query(since, serverDiff)
+            studentCount = 0
+            for batchSize, lines in process_students(cur, query, binds, snapshot, metrics, columnar, report):
+                if lines:
+                    write(lines)
+                studentCount += batchSize
+    return runStarted, studentCount
+
+
+def process_school(pool, schoolid, since, serverDiff, snapshot, metrics, columnar, report):
+    """Worker for parallel runs, which processes the students of a single school on its own connection from the pool. Returns the output lines (newest student number first) and the number of students processed."""
+    with pool.acquire() as con:
+        with con.cursor() as cur:
+            query, binds = build_query(since, serverDiff, schoolid)
+            schoolLines = []
+            studentCount = 0
+            for batchSize, lines in process_students(cur, query, binds, snapshot, metrics, columnar, report):
+                schoolLines.extend(lines)
+                studentCount += batchSize
+    logger.debug('Finished processing %s students from school %s', studentCount, schoolid)
+    return schoolLines, studentCount
+
+
+def output_student_number(line):
+    """Return the student number an output line is for, used as the sort key when merging the results of each school."""
+    return int(line.split('\t', 1)[0])
+
+
+def run_parallel(since, serverDiff, snapshot, write, workers, metrics, columnar, report):
+    """Split the students up by school and process the schools in a pool of worker threads, each with its own connection from a shared connection pool.
+
+    The output lines of each school are already in student number order, so they are merged back together to give the same file a serial run would.
+    Returns the database time the run started at and the number of students processed. The phase timings of the workers are added together, so can add up to more than the run took.
+    """
+    with metrics.phase('db_connect'):
+        pool = oracledb.create_pool(user=DB_UN, password=DB_PW, dsn=DB_CS, min=1, max=workers, increment=1)
+    try:
+        with pool.acquire() as con:
+            with con.cursor() as cur:
+                logger.info(f'Connection pool established to PS database on version: {con.version}')
+                runStarted = database_time(cur)
+                cur.execute('SELECT DISTINCT schoolid FROM students ORDER BY schoolid')
+                schools = [row[0] for row in cur.fetchall()]
+        logger.info(f'Processing {len(schools)} schools with {workers} workers')
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda schoolid: process_school(pool, schoolid, since, serverDiff, snapshot, metrics, columnar, report), schools))
+    finally:
+        pool.close()
+    write(list(heapq.merge(*[schoolLines for schoolLines, _ in results], key=output_student_number, reverse=True)))
+    return runStarted, sum(studentCount for _, studentCount in results)
+
+
+def file_sha256(fileName):
+    """Return the sha256 hash of a local file as a hex string."""
+    fileHash = hashlib.sha256()
+    with open(fileName, 'rb') as hashFile:
+        for chunk in iter(lambda: hashFile.read(UPLOAD_CHUNK_SIZE), b''):
+            fileHash.update(chunk)
+    return fileHash.hexdigest()
+
+
+def remote_manifest(sftp, fileName):
+    """Return the hash recorded in the manifest for fileName on the sftp server, or None if there is no manifest or the file no longer has the size it lists (so was changed by something else)."""
+    manifestName = fileName + UPLOAD_MANIFEST_SUFFIX
+    if not sftp.exists(manifestName) or not sftp.exists(fileName):
+        return None
+    with sftp.open(manifestName, 'r') as manifest:
+        try:
+            remoteHash, remoteSize = manifest.read().decode().split()
+            remoteSize = int(remoteSize)
+        except ValueError:  # empty or cut off manifest, so we cannot trust it and just upload again
+            logger.warning(f'Manifest {manifestName} on the remote server could not be read, it will be replaced')
+            return None
+    return remoteHash if sftp.stat(fileName).st_size == remoteSize else None
+
+
+def replace_remote(sftp, tempName, fileName):
+    """Rename tempName over fileName in the current sftp directory, atomically if the server supports posix-rename."""
+    try:
+        sftp.sftp_client.posix_rename(tempName, fileName)  # atomically replaces the old file
+    except IOError:  # server does not support posix-rename, fall back to removing the old file first
+        if sftp.exists(fileName):
+            sftp.remove(fileName)
+        sftp.rename(tempName, fileName)
+
+
+def send_file(sftp, fileName, tempName, size):
+    """Upload a local file to tempName in the current sftp directory, picking up from the end of any partial copy a previous attempt left behind."""
+    offset = sftp.stat(tempName).st_size if sftp.exists(tempName) else 0
+    if offset > size:  # should not be possible since the temp name includes the hash, but start over just in case
+        offset = 0
+    if offset:
+        logger.info(f'Resuming upload of {fileName} from byte {offset} of {size}')
+    with open(fileName, 'rb') as localFile, sftp.open(tempName, 'ab' if offset else 'wb') as remoteFile:
+        localFile.seek(offset)
+        for chunk in iter(lambda: localFile.read(UPLOAD_CHUNK_SIZE), b''):
+            remoteFile.write(chunk)
+    if sftp.stat(tempName).st_size != size:
+        raise IOError(f'uploaded file is {sftp.stat(tempName).st_size} bytes but should be {size}')
+
+
+def connect_sftp(directory, metrics=None):
+    """Open a connection to the D118 SFTP server in the output directory. Run in the background at the start of the run so the key exchange and login overlap with the PowerSchool query."""
+    connectStart = perf_counter()
+    sftp = pysftp.Connection(SFTP_HOST, username=SFTP_UN, password=SFTP_PW, cnopts=CNOPTS)
+    logger.info(f'SFTP connection to D118 at {SFTP_HOST} successfully established')
+    sftp.chdir(directory)
+    if metrics is not None:
+        metrics.add_phase('sftp_connect', perf_counter() - connectStart)
+    return sftp
+
+
+def upload_output(fileName, directory, connecting=None):
+    """Upload the output file to the sftp server so it can be imported into PowerSchool, returning True if the server ends up with the current file and False if every attempt failed.
+
+    The upload is skipped if the manifest on the server shows it already has a file with the same hash, since importing it again would do nothing.
+    Otherwise the file is written to a temporary name that includes its hash and then renamed over the real one, so PowerSchool can never pick up a partial file.
+    Failed attempts are retried on a new connection, resuming the partial temporary file where it left off, and the manifest is only updated once the rename is done.
+    If connecting is passed, it is a Future for the connection from connect_sftp() that was started earlier in the run, and is used for the first attempt.
+    """
+    localHash = file_sha256(fileName)
+    localSize = os.path.getsize(fileName)
+    tempName = f'.{fileName}.{localHash[:16]}.part'
+    for attempt in range(1, UPLOAD_RETRIES + 1):
+        try:
+            # connect to the D118 SFTP server (or pick up the connection opened during the query) and use the one connection for the whole upload
+            with connecting.result() if connecting is not None and attempt == 1 else connect_sftp(directory) as sftp:
+                if remote_manifest(sftp, fileName) == localHash:
+                    logger.info(f'Student services file on remote server is already identical ({localHash[:16]}), skipping upload')
+                    return True
+                send_file(sftp, fileName, tempName, localSize)
+                replace_remote(sftp, tempName, fileName)
+                manifestTempName = f'.{fileName}{UPLOAD_MANIFEST_SUFFIX}.part'
+                with sftp.open(manifestTempName, 'w') as manifest:  # written to a temporary name as well so a dropped connection can not leave a partial manifest
+                    manifest.write(f'{localHash} {localSize}\n')
+                replace_remote(sftp, manifestTempName, fileName + UPLOAD_MANIFEST_SUFFIX)
+                for leftover in sftp.listdir():  # clean up partial uploads of older versions of the file
+                    if leftover.startswith(f'.{fileName}.') and leftover.endswith('.part'):
+                        sftp.remove(leftover)
+                logger.info(f'Student services file placed on remote server ({localSize} bytes, {localHash[:16]})')
+                return True
+        except Exception as er:
+            logger.warning(f'Upload attempt {attempt} of {UPLOAD_RETRIES} to D118 SFTP server failed: {er}')
+            if attempt < UPLOAD_RETRIES:
+                sleep(UPLOAD_RETRY_DELAY)
+    logger.error(f'Error while uploading to D118 SFTP server, giving up after {UPLOAD_RETRIES} attempts')
+    return False
+
 
 if __name__ == '__main__':  # main file execution
-    with open('counselor_log.txt', 'w') as log:  # open the logging file
+    parser = argparse.ArgumentParser(description='Find the student services staff for each student and upload any changes for import into PowerSchool')
+    parser.add_argument('--server-diff', action='store_true', help='work out the staff assignments in the SQL query and only return students whose stored staff needs to change, instead of pulling every student')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='lowest level of message to print and write to the log file, DEBUG shows the processing of every student (default: INFO)')
+    parser.add_argument('--workers', type=int, default=1, help='number of schools to process at once, each in its own thread with its own database connection (default: 1, which processes all students in one query)')
+    parser.add_argument('--columnar', action='store_true', help='process each batch of students as typed columns with the staff names dictionary encoded, which is faster and uses less memory on large runs but skips the DBUG line for every student')
+    parser.add_argument('--dry-run', action='store_true', help=f'do not upload the output file, and instead write a report of the changes that would be made to {CHANGE_REPORT_JSON_FILE} and {CHANGE_REPORT_CSV_FILE}')
+    parser.add_argument('--full', action='store_true', help='ignore the local snapshot from previous runs and process every student, rebuilding the snapshot')
+    args = parser.parse_args()
+
+    with open(LOG_FILE_NAME, 'w', buffering=LOG_BUFFER_SIZE) as log, run_logging(log, args.log_level):  # open the logging file and start the background log writer
         startTime = datetime.now()
         startTime = startTime.strftime('%H:%M:%S')
-        print(f'INFO: Execution started at {startTime}')
-        print(f'INFO: Execution started at {startTime}', file=log)
+        logger.info(f'Execution started at {startTime}')
+        logger.debug(f'Database Username: {DB_UN} |Password: {"set" if DB_PW else "not set"} |Server: {DB_CS}')  # debug so we can see where oracle is trying to connect to/with, without writing the password to the log file
+        logger.debug(f'SFTP Username: {SFTP_UN} | D118 SFTP Password: {"set" if SFTP_PW else "not set"} | D118 SFTP Server: {SFTP_HOST}')  # debug so we can see what info sftp connection is using
+        snapshot = AssignmentSnapshot(STATE_FILE_NAME)
+        since = None if args.full else snapshot.last_run()  # only look at students modified since the last successful run, unless this is the first run or the caseloads changed
+        if since is None:
+            logger.info('Doing a full run of all students and rebuilding the snapshot of assignments')
+            snapshot.clear()
+        else:
+            logger.info(f'Doing an incremental run of students modified since {since}')
+        runStarted = None  # database time the query was started at, only filled in if the query finishes so we know the snapshot is safe to save
+        if args.server_diff:
+            logger.info('Running in server side diff mode, only students whose staff needs to change will be returned by the query')
+        metrics = RunMetrics()
+        report = ChangeReport() if args.dry_run else None
+        if args.dry_run:
+            logger.info('Running in dry run mode, the output file will not be uploaded')
+        else:
+            connector = ThreadPoolExecutor(max_workers=1)  # open the sftp connection in the background while the query runs
+            sftpConnecting = connector.submit(connect_sftp, OUTPUT_FILE_DIRECTORY, metrics)
+            connector.shutdown(wait=False)
         with open(OUTPUT_FILE_NAME, 'w') as output:  # open the output file
-            with oracledb.connect(user=DB_UN, password=DB_PW, dsn=DB_CS) as con:  # create the connecton to the database
-                try:
-                    with con.cursor() as cur:  # start an entry cursor
-                        print(f'INFO: Connection established to PS database on version: {con.version}')
-                        print(f'INFO: Connection established to PS database on version: {con.version}', file=log)
-
-                        cur.execute('SELECT stu.student_number, stu.last_name, stu.grade_level, stu.enroll_status, stu.schoolid, stufields.custom_counselor, stufields.custom_deans_house, stuext.custom_social, stuext.custom_psych, stufields.custom_counselor_email, stuext.academy, stuext.ils, stufields.custom_deans_house_email, stufields.custom_social_email, stufields.custom_psych_email\
-                        FROM students stu LEFT JOIN u_studentsuserfields stufields ON stu.dcid = stufields.studentsdcid LEFT JOIN u_def_ext_students0 stuext ON stu.dcid = stuext.studentsdcid ORDER BY stu.student_number DESC')
-                        students = cur.fetchall()
-                        for student in students:
-                            try:
-                                stuID = int(student[0])
-                                last = str(student[1]).lower()
-                                grade = int(student[2])
-                                enroll = int(student[3])
-                                school = int(student[4])
-                                currentCounselor = str(student[5]) if student[5] else ''
-                                currentCounselorEmail = str(student[9]) if student[9] else ''
-                                currentDean = str(student[6]) if student[6] else ''
-                                currentDeanEmail = str(student[12]) if student[12] else ''
-                                currentSocial = str(student[7]) if student[7] else ''
-                                currentSocialEmail = str(student[13]) if student[13] else ''
-                                currentPsych = str(student[8]) if student[8] else ''
-                                currentPsychEmail = str(student[14]) if student[14] else ''
-                                isAcademy = True if student[10] == 1 else False
-                                isILS = True if student[11] == 1 else False
-                                counselor = ''  # reset to blank for each student just in case so output does not carry over between students
-                                counselorEmail = ''  # reset to blank for each student just in case so output does not carry over between students
-                                dean = ''  # reset to blank for each student just in case so output does not carry over between students
-                                deanEmail = ''  # reset to blank for each student just in case so output does not carry over between students
-                                social = ''  # reset to blank for each student just in case so output does not carry over between students
-                                socialEmail = ''  # reset to blank for each student just in case so output does not carry over between students
-                                psych = ''  # reset to blank for each student just in case so output does not carry over between students
-                                psychEmail = ''  # reset to blank for each student just in case so output does not carry over between students
-                                changed = False  # boolean to represent whether we need to include this student in the output because anything has changed
-                                if grade in range(9,13) and enroll == 0:  # process high schoolers
-                                    print(f'DBUG: {stuID}: {last} is in grade {grade} and active, will process as a high schooler')
-                                    # print(f'DBUG: {stuID}: {last} is in grade {grade} and active, will process as a high schooler', file=log)
-                                    if (last[0] == 'a'):  # A last names
-                                        counselor = WHS_GUIDANCE_1
-                                        counselorEmail = WHS_GUIDANCE_1_EMAIL
-                                        dean = WHS_DEAN_1
-                                        deanEmail = WHS_DEAN_1_EMAIL
-                                        social = WHS_SOCIAL_1
-                                        socialEmail = WHS_SOCIAL_1_EMAIL
-                                        psych = WHS_PSYCH_1
-                                        psychEmail = WHS_PSYCH_1_EMAIL
-                                        # print('DBUG: Student has a last name starting with A', file=log)
-                                    elif (last[0] < 'g'):  # B-F
-                                        counselor = WHS_GUIDANCE_2
-                                        counselorEmail = WHS_GUIDANCE_2_EMAIL
-                                        dean = WHS_DEAN_1
-                                        deanEmail = WHS_DEAN_1_EMAIL
-                                        social = WHS_SOCIAL_1
-                                        socialEmail = WHS_SOCIAL_1_EMAIL
-                                        psych = WHS_PSYCH_1
-                                        psychEmail = WHS_PSYCH_1_EMAIL
-                                        # print('DBUG: Student has a last name between B-F', file=log)
-                                    elif (last[0] == 'g'):  # if they are D, we need to check next letter as Da-Dh is one while Di-Dz is another
-                                        counselor = WHS_GUIDANCE_2 if (last[1] == 'a') else WHS_GUIDANCE_3  # check second letter
-                                        counselorEmail = WHS_GUIDANCE_2_EMAIL if (last[1] == 'a') else WHS_GUIDANCE_3_EMAIL  # check second letter
-                                        dean = WHS_DEAN_1
-                                        deanEmail = WHS_DEAN_1_EMAIL
-                                        social = WHS_SOCIAL_1
-                                        socialEmail = WHS_SOCIAL_1_EMAIL
-                                        psych = WHS_PSYCH_1
-                                        psychEmail = WHS_PSYCH_1_EMAIL
-                                        # print('DBUG: Student has name starting with G, finding correct counselor based on second letter - ' + last[1], file=log)
-                                    elif (last[0] < 'm'):  # H-L
-                                        counselor = WHS_GUIDANCE_3
-                                        counselorEmail = WHS_GUIDANCE_3_EMAIL
-                                        dean = WHS_DEAN_1
-                                        deanEmail = WHS_DEAN_1_EMAIL
-                                        social = WHS_SOCIAL_1
-                                        socialEmail = WHS_SOCIAL_1_EMAIL
-                                        psych = WHS_PSYCH_1
-                                        psychEmail = WHS_PSYCH_1_EMAIL
-                                        # print('DBUG: Student has name between H-L', file=log)
-                                    elif (last[0] < 'r'):  # M-Q
-                                        counselor = WHS_GUIDANCE_4
-                                        counselorEmail = WHS_GUIDANCE_4_EMAIL
-                                        dean = WHS_DEAN_2
-                                        deanEmail = WHS_DEAN_2_EMAIL
-                                        social = WHS_SOCIAL_2
-                                        socialEmail = WHS_SOCIAL_2_EMAIL
-                                        psych = WHS_PSYCH_2
-                                        psychEmail = WHS_PSYCH_2_EMAIL
-                                        # print('DBUG: Student has name between M-Q', file=log)
-                                    elif (last[0] == 'r'):  # same situation as G, R is split
-                                        counselor = WHS_GUIDANCE_4 if (last[1] < 'j') else WHS_GUIDANCE_5
-                                        counselorEmail = WHS_GUIDANCE_4_EMAIL if (last[1] < 'j') else WHS_GUIDANCE_5_EMAIL
-                                        dean = WHS_DEAN_2
-                                        deanEmail = WHS_DEAN_2_EMAIL
-                                        social = WHS_SOCIAL_2
-                                        socialEmail = WHS_SOCIAL_2_EMAIL
-                                        psych = WHS_PSYCH_2
-                                        psychEmail = WHS_PSYCH_2_EMAIL
-                                        # print('DBUG: Student has name starting with R, finding correct counselor based on second letter - ' + last[1], file=log)
-                                    elif (last[0] <= 'z'):  # S-Z
-                                        counselor = WHS_GUIDANCE_5
-                                        counselorEmail = WHS_GUIDANCE_5_EMAIL
-                                        dean = WHS_DEAN_2
-                                        deanEmail = WHS_DEAN_2_EMAIL
-                                        social = WHS_SOCIAL_2
-                                        socialEmail = WHS_SOCIAL_2_EMAIL
-                                        psych = WHS_PSYCH_2
-                                        psychEmail = WHS_PSYCH_2_EMAIL
-                                        # print('DBUG: Student has name between S-Z', file=log)
-                                    else:  # just in case we get through all possible
-                                        counselor = 'ERROR'
-                                        print('ERROR: Student last name processing failed', file=log)
-
-                                    # do an override for academy and ILS students
-                                    if isAcademy:
-                                        counselor = WHS_GUIDANCE_ACADEMY
-                                        counselorEmail = WHS_GUIDANCE_ACADEMY_EMAIL
-                                        social = WHS_SOCIAL_ACADEMY
-                                        socialEmail = WHS_SOCIAL_ACADEMY_EMAIL
-                                        print('DBUG: Student is an academy student, overriding their counselor and social worker', file=log)
-                                    if isILS:
-                                        social = WHS_SOCIAL_ILS
-                                        socialEmail = WHS_SOCIAL_ILS_EMAIL
-                                        print('DBUG: Student is an ILS student, overriding their social worker', file=log)
-
-                                elif (school == 1003 or school == 1004) and enroll == 0:  # if they are a middle schooler they all have the same counselor per building
-                                    print(f'DBUG: {stuID}: {last} is in grade {grade} at building {school} and is active, will process as a middle schooler')
-                                    # print(f'DBUG: {stuID}: {last} is in grade {grade} at building {school} and is active, will process as a middle schooler', file=log)
-                                    counselor = WMS_GUIDANCE if school == 1003 else MMS_GUIDANCE
-                                    counselorEmail = WMS_GUIDANCE_EMAIL if school == 1003 else MMS_GUIDANCE_EMAIL
-                                    dean = ''
-                                    deanEmail = ''
-                                    social = WMS_SOCIAL if school == 1003 else MMS_SOCIAL
-                                    socialEmail = WMS_SOCIAL_EMAIL if school == 1003 else MMS_SOCIAL_EMAIL
-                                    psych = WMS_PSYCH if school == 1003 else MMS_PSYCH
-                                    psychEmail = WMS_PSYCH_EMAIL if school == 1003 else MMS_PSYCH_EMAIL
-                                else:  # if they are not in 6-12 or are not active, blank out all their fields
-                                    print(f'DBUG: {stuID} has a grade level of {grade} at school {school} and enroll status of {enroll}, so they will be set to blanks')
-                                    # print(f'DBUG: {stuID} has a grade level of {grade} at school {school} and enroll status of {enroll}, so they will be set to blanks', file=log)
-                                    counselor = ''
-                                    counselorEmail = ''
-                                    dean = ''
-                                    deanEmail = ''
-                                    social = ''
-                                    socialEmail = ''
-                                    psych = ''
-                                    psychEmail = ''
-                                print(f'DBUG: {stuID} in grade {grade} at school {school}- Counselor: {counselor}-{counselorEmail} | Dean: {dean}-{deanEmail} | Social Worker: {social}-{socialEmail} | Psychologist: {psych}-{psychEmail}', file=log)  # debug
-
-                                # check to see if their counselor, dean, psychologist or social worker changed from the current value, warn if they are changing from other values and are enrolled as a sanity check
-                                if counselor != currentCounselor:
-                                    changed = True
-                                    if enroll == 0 and currentCounselor != '':
-                                        print(f'WARN: {stuID} is changing from the counselor of {currentCounselor} to {counselor}')
-                                        print(f'WARN: {stuID} is changing from the counselor of {currentCounselor} to {counselor}', file=log)
-                                if counselorEmail != currentCounselorEmail:
-                                    changed = True
-                                    if enroll == 0 and currentCounselorEmail != '':
-                                        print(f'WARN: {stuID} is changing from the counselor email of {currentCounselorEmail} to {counselorEmail}')
-                                        print(f'WARN: {stuID} is changing from the counselor email of {currentCounselorEmail} to {counselorEmail}', file=log)
-                                if dean != currentDean:
-                                    changed = True
-                                    if enroll == 0 and currentDean != '':
-                                        print(f'WARN: {stuID} is changing from the dean of {currentDean} to {dean}')
-                                        print(f'WARN: {stuID} is changing from the dean of {currentDean} to {dean}', file=log)
-                                if deanEmail != currentDeanEmail:
-                                    changed = True
-                                    if enroll == 0 and currentDeanEmail != '':
-                                        print(f'WARN: {stuID} is changing from the dean email of {currentDeanEmail} to {deanEmail}')
-                                        print(f'WARN: {stuID} is changing from the dean email of {currentDeanEmail} to {deanEmail}', file=log)
-                                if social != currentSocial:
-                                    changed = True
-                                    if enroll == 0 and currentSocial != '':
-                                        print(f'WARN: {stuID} is changing from the social worker of {currentSocial} to {social}')
-                                        print(f'WARN: {stuID} is changing from the social worker of {currentSocial} to {social}', file=log)
-                                if socialEmail != currentSocialEmail:
-                                    changed = True
-                                    if enroll == 0 and currentSocialEmail != '':
-                                        print(f'WARN: {stuID} is changing from the social worker email of {currentSocialEmail} to {socialEmail}')
-                                        print(f'WARN: {stuID} is changing from the social worker email of {currentSocialEmail} to {socialEmail}', file=log)
-                                if psych != currentPsych:
-                                    changed = True
-                                    if enroll == 0 and currentPsych != '':
-                                        print(f'WARN: {stuID} is changing from the psychologist of {currentPsych} to {psych}')
-                                        print(f'WARN: {stuID} is changing from the psychologist of {currentPsych} to {psych}', file=log)
-                                if psychEmail != currentPsychEmail:
-                                    changed = True
-                                    if enroll == 0 and currentPsychEmail != '':
-                                        print(f'WARN: {stuID} is changing from the psychologist email of {currentPsychEmail} to {psychEmail}')
-                                        print(f'WARN: {stuID} is changing from the psychologist email of {currentPsychEmail} to {psychEmail}', file=log)
-
-                                # do the final output to the text file only if there is change in any of the values for the student
-                                if changed:
-                                    if school not in IGNORED_SCHOOLS:
-                                        print(f'{stuID}\t{counselor}\t{dean}\t{social}\t{psych}\t{counselorEmail}\t{deanEmail}\t{socialEmail}\t{psychEmail}', file=output)
-                                    else: 
-                                        print(f'WARN: {stuID} is marked that information needs to be changed but will not be because they are in the ignored school code {school}')
-                                        print(f'WARN: {stuID} is marked that information needs to be changed but will not be because they are in the ignored school code {school}', file=log)
-
-                            except Exception as er:
-                                print(f'ERROR while processing student {student[0]}: {er}')
-                                print(f'ERROR while processing student {student[0]}: {er}', file=log)
-
-                except Exception as er:
-                    print(f'ERROR while doing PowerSchool query: {er}')
-                    print(f'ERROR while doing PowerSchool query: {er}', file=log)
+            try:
+                queryStart = perf_counter()
+                with output_writer(output, metrics) as write:  # lines are written to the file in the background as each batch is processed
+                    if args.workers > 1:
+                        queryStarted, studentCount = run_parallel(since, args.server_diff, snapshot, write, args.workers, metrics, args.columnar, report)
+                    else:
+                        queryStarted, studentCount = run_serial(since, args.server_diff, snapshot, write, metrics, args.columnar, report)
+                runStarted = queryStarted  # only filled in once every line has made it to the file
+                queryElapsed = perf_counter() - queryStart
+                logger.info(f'Processed {studentCount} students in {queryElapsed:.2f} seconds ({studentCount / queryElapsed if queryElapsed else 0:.0f} rows/sec)')
+            except Exception as er:
+                logger.error(f'Error while doing PowerSchool query: {er}')
 
-        try:
-            # Now connect to the D118 SFTP server and upload the file to be imported into PowerSchool
-            with pysftp.Connection(SFTP_HOST, username=SFTP_UN, password=SFTP_PW, cnopts=CNOPTS) as sftp:
-                print(f'INFO: SFTP connection to D118 at {SFTP_HOST} successfully established')
-                print(f'INFO: SFTP connection to D118 at {SFTP_HOST} successfully established', file=log)
-                # print(sftp.pwd)  # debug to show current directory
-                # print(sftp.listdir())  # debug to show files and directories in our location
-                sftp.chdir(OUTPUT_FILE_DIRECTORY)
-                # print(sftp.pwd) # debug to show current directory
-                # print(sftp.listdir())  # debug to show files and directories in our location
-                sftp.put(OUTPUT_FILE_NAME)  # upload the file to our sftp server
-                print("INFO: Student services file placed on remote server")
-                print("INFO: Student services file placed on remote server", file=log)
-        except Exception as er:
-            print(f'ERROR while connecting to D118 SFTP server: {er}')
-            print(f'ERROR while connecting to D118 SFTP server: {er}', file=log)
+        if args.dry_run:  # write the change report instead of uploading, and leave the snapshot alone so the real run still picks up these students
+            uploaded = False
+            try:
+                with metrics.phase('report'):
+                    summary = report.export(CHANGE_REPORT_JSON_FILE, CHANGE_REPORT_CSV_FILE)
+                logger.info(f'Dry run: {summary["students_changed"]} students would have their staff changed, see {CHANGE_REPORT_JSON_FILE} and {CHANGE_REPORT_CSV_FILE} for the details')
+            except Exception as er:
+                logger.error(f'Error while writing the change report: {er}')
+        else:  # Now upload the file to the D118 SFTP server to be imported into PowerSchool
+            with metrics.phase('upload'):
+                uploaded = upload_output(OUTPUT_FILE_NAME, OUTPUT_FILE_DIRECTORY, sftpConnecting)
+
+        # only keep the new snapshot if the changes actually made it to the server, otherwise the next run needs to pick the same students up again
+        if runStarted is not None and uploaded:
+            snapshot.save(runStarted)
+        elif not args.dry_run:
+            logger.warning('Run did not complete, the snapshot of assignments was not updated')
+        snapshot.close()
+
+        logger.info('Phase timings: ' + ' | '.join(f'{phase} {seconds:.3f}s' for phase, seconds in metrics.phases.items()))
+        if not args.dry_run:  # a preview run should not replace the metrics of the last real run that monitoring looks at
+            try:
+                metrics.export(METRICS_JSON_FILE, METRICS_PROMETHEUS_FILE)
+            except Exception as er:
+                logger.error(f'Error while writing run metrics: {er}')
 
         endTime = datetime.now()
         endTime = endTime.strftime('%H:%M:%S')
-        print(f'INFO: Execution ended at {endTime}')
-        print(f'INFO: Execution ended at {endTime}', file=log)
+        logger.info(f'Execution ended at {endTime}')